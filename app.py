@@ -1,13 +1,19 @@
 import streamlit as st
 import base64
 from mistralai import Mistral
+from mistralai.models import SDKError
+import httpx
 import pandas as pd
 from io import BytesIO
 import json
-import re
-import pdfplumber
+import hashlib
+import fitz  # PyMuPDF
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import threading
+import os
+from concurrent.futures import ThreadPoolExecutor
+import random
 
 # --- App Title ---
 st.title("Mistral Table Extractor (Fast Multi-Image & PDF)")
@@ -17,6 +23,9 @@ source_option = st.sidebar.selectbox(
     "Select source",
     ["From Images", "From PDF"]
 )
+batch_size = st.sidebar.slider("Pages per request", min_value=1, max_value=8, value=4)
+max_parallel_requests = st.sidebar.number_input("Max parallel requests", min_value=1, max_value=64, value=32)
+requests_per_minute = st.sidebar.number_input("Max requests per minute", min_value=1, max_value=6000, value=300)
 
 # --- Dynamic Description ---
 if source_option == "From Images":
@@ -27,11 +36,19 @@ elif source_option == "From PDF":
 # --- API Client ---
 try:
     api_key = st.secrets["MISTRAL_API_KEY"]
-    client = Mistral(api_key=api_key)
 except KeyError:
     st.error("Mistral API key not found. Add it to `.streamlit/secrets.toml`.")
     st.stop()
 
+# One pooled HTTP/2 connection set per extraction run, sized so every in-flight request
+# reuses a kept-alive connection instead of paying a new TCP+TLS handshake.
+def make_http_client(max_connections):
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        timeout=60
+    )
+
 # --- File Upload ---
 uploaded_files = None
 if source_option == "From Images":
@@ -46,50 +63,291 @@ elif source_option == "From PDF":
     uploaded_files = st.file_uploader("Choose a PDF file...", type=["pdf"], accept_multiple_files=False)
 
 # --- PDF to Images ---
-# Updated function to remove resizing and use a higher resolution by default
-def pdf_to_images(file_bytes, resolution=200):
-    images = []
-    with pdfplumber.open(BytesIO(file_bytes)) as pdf:
-        for page in pdf.pages:
-            img = page.to_image(resolution=resolution).original
-            images.append(img)
-    return images
+# Yields one page at a time so extraction can start before the whole PDF is rasterized.
+# PyMuPDF renders much faster than pdfplumber; each pixmap is dropped once copied into a PIL image.
+def iter_pdf_pages(file_bytes, resolution=200):
+    zoom = resolution / 72
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        for page in doc:
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            pix = None
+            yield img
+
+def pdf_page_count(file_bytes):
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        return doc.page_count
+
+def iter_uploaded_images(files):
+    for f in files:
+        yield Image.open(f)
+
+# --- Blank Page Check ---
+# Counts "ink": pixels more than `ink_contrast` grey levels from the paper, taken as the median
+# level. The low contrast keeps faded or low-contrast text, and a page is skipped only when it
+# has almost no ink at all (10 pixels per million), so even a lone digit still gets sent.
+def is_blank_page(img, ink_fraction=0.00001, ink_contrast=32):
+    histogram = img.convert("L").histogram()
+    total = sum(histogram)
+    cumulative = 0
+    for paper_level, count in enumerate(histogram):
+        cumulative += count
+        if cumulative * 2 >= total:
+            break
+    ink_pixels = (
+        sum(histogram[:max(paper_level - ink_contrast, 0)])
+        + sum(histogram[paper_level + ink_contrast + 1:])
+    )
+    return ink_pixels < total * ink_fraction
+
+# --- Duplicate Page Check ---
+# Hashes the full pixel data, so only pixel-identical pages match; a thumbnail would merge
+# pages that differ in a single digit.
+def page_fingerprint(img):
+    digest = hashlib.sha256(f"{img.mode}:{img.size}".encode("ascii"))
+    digest.update(img.tobytes())
+    return digest.digest()
 
 # --- Convert PIL Image to Base64 ---
+# Each thread reuses one encode buffer instead of allocating a new BytesIO per page.
+_thread_local = threading.local()
+
+def _encode_buffer():
+    buf = getattr(_thread_local, "buf", None)
+    if buf is None:
+        buf = _thread_local.buf = BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    return buf
+
+# Transparent areas become white; a plain convert("RGB") would turn them black and hide dark text.
+def flatten_to_rgb(img):
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    if img.mode not in ("RGB", "L"):
+        return img.convert("RGB")
+    return img
+
+# Encodes straight from the buffer's memory instead of copying it out with getvalue().
+# JPEG because invoices don't need lossless compression and the payload is several times smaller.
 def image_to_base64(img):
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
-
-# --- Mistral Extraction for One Image ---
-def process_image(img, instruction_prompt):
-    base64_file = image_to_base64(img)
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": instruction_prompt},
-                {"type": "image_url", "image_url": f"data:image/png;base64,{base64_file}"}
-            ]
-        }
+    buf = _encode_buffer()
+    flatten_to_rgb(img).save(buf, format="JPEG", quality=85, optimize=True)
+    with buf.getbuffer() as view:
+        return base64.b64encode(view).decode("ascii")
+
+# --- Read and Classify the Next Page ---
+# Runs on a worker thread: decoding, flattening, hashing and the blank check touch every pixel
+# and would otherwise stall in-flight requests. Flattening first stops a transparent background
+# from reading as solid black.
+def next_page(pages, seen_pages):
+    img = next(pages, None)
+    if img is None:
+        return None, None
+    flat = flatten_to_rgb(img)
+    if flat is not img:
+        img.close()
+        img = flat
+    fingerprint = page_fingerprint(img)
+    if fingerprint in seen_pages:
+        return img, "duplicate"
+    if is_blank_page(img):
+        return img, "blank"
+    seen_pages.add(fingerprint)
+    return img, None
+
+# --- Parse Model Output ---
+# Tries raw_decode at each "[" in turn and collects the row objects from every array that
+# decodes, so per-page arrays and stray brackets in surrounding prose are both handled.
+_json_decoder = json.JSONDecoder()
+
+def parse_json_array(text):
+    rows = []
+    start = text.find("[")
+    while start >= 0:
+        try:
+            obj, end = _json_decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            start = text.find("[", start + 1)
+            continue
+        if isinstance(obj, list):
+            rows.extend(item for item in obj if isinstance(item, dict))
+        start = text.find("[", end)
+    return rows
+
+# --- Build Result Table ---
+# Expected columns come first in the user's order; any other keys the model returned follow.
+def rows_to_dataframe(rows, expected_columns):
+    df = pd.DataFrame(rows)
+    return df.reindex(columns=expected_columns + [c for c in df.columns if c not in expected_columns])
+
+# --- Response Cache ---
+# Parsed rows keyed by SHA-256 of the prompt and image payloads. The dict survives reruns and is
+# shared by every session, so all access holds its lock. Keys cover a whole batch.
+RESPONSE_CACHE_SIZE = 256
+
+@st.cache_resource
+def get_response_cache():
+    return {}, threading.Lock()
+
+def batch_cache_key(image_urls, instruction_prompt):
+    digest = hashlib.sha256(instruction_prompt.encode("utf-8"))
+    for url in image_urls:
+        digest.update(hashlib.sha256(url.encode("utf-8")).digest())
+    return digest.hexdigest()
+
+# --- Rate Limiting & Retries ---
+# Spaces request starts evenly so no more than `requests_per_minute` begin per minute.
+# Slots are reserved without awaiting in between, so no lock is needed on the event loop.
+class RateLimiter:
+    def __init__(self, requests_per_minute):
+        self.interval = 60 / requests_per_minute
+        self.next_slot = 0.0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+MAX_RETRY_DELAY = 60
+
+def retry_after_seconds(error):
+    response = getattr(error, "raw_response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+# Retries rate-limit, 5xx and connection errors with jittered exponential backoff, honouring
+# Retry-After when the API sends it; every wait is capped at MAX_RETRY_DELAY seconds.
+async def complete_with_retry(client, messages, rate_limiter):
+    for attempt in range(MAX_ATTEMPTS):
+        await rate_limiter.wait()
+        try:
+            return await client.chat.complete_async(model="mistral-large-latest", messages=messages)
+        except SDKError as e:
+            if e.status_code not in RETRY_STATUS_CODES or attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = retry_after_seconds(e)
+        except httpx.TransportError:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = None
+        if delay is None:
+            delay = min(2 ** attempt, 30) + random.uniform(0, 1)
+        await asyncio.sleep(min(delay, MAX_RETRY_DELAY))
+
+# --- Encode Stage ---
+# Runs in a small thread pool (PIL releases the GIL while compressing). The image is closed
+# once encoded, and only the data URL travels on, so retries never re-encode a page.
+ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+
+def encode_page(img):
+    try:
+        return f"data:image/jpeg;base64,{image_to_base64(img)}"
+    finally:
+        img.close()
+
+# --- Mistral Extraction for a Batch of Images ---
+async def process_image_batch(client, image_urls, instruction_prompt, rate_limiter):
+    cache, cache_lock = get_response_cache()
+    key = batch_cache_key(image_urls, instruction_prompt)
+    with cache_lock:
+        cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    content = [
+        {"type": "text", "text": instruction_prompt + "\nReturn a JSON array concatenating rows from all images in order."}
     ]
-    response = client.chat.complete(model="mistral-large-latest", messages=messages)
+    content.extend({"type": "image_url", "image_url": url} for url in image_urls)
+    messages = [{"role": "user", "content": content}]
+    response = await complete_with_retry(client, messages, rate_limiter)
     extracted_text = response.choices[0].message.content.strip()
-    if not extracted_text:
-        return []
-    json_match = re.search(r"\[.*\]", extracted_text, re.DOTALL)
-    if not json_match:
-        return []
-    return json.loads(json_match.group(0))
+    rows = parse_json_array(extracted_text)
+
+    # Empty or unparseable replies are not cached so that extracting again retries them.
+    if rows:
+        with cache_lock:
+            if len(cache) >= RESPONSE_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+            cache[key] = rows
+    return rows
 
 # --- Concurrent Processing ---
-def process_images_concurrent(images, instruction_prompt, max_workers=8):
-    all_data = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(process_image, img, instruction_prompt) for img in images]
-        for future in as_completed(futures):
-            all_data.extend(future.result())
-    return all_data
+# Pages are read, filtered (blank or duplicate) and JPEG-encoded off the event loop, then
+# sent `batch_size` per request over one pooled client; a semaphore slot per batch caps what
+# is held or in flight at `concurrency`, and all batches share one rate limiter.
+# `on_batch(rows, pages_done)` reports progress; the first failure cancels the rest.
+async def process_images_async(images, instruction_prompt, concurrency=32, batch_size=4, on_batch=None,
+                               requests_per_minute=300):
+    sem = asyncio.Semaphore(concurrency)
+    rate_limiter = RateLimiter(requests_per_minute)
+    failed = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    pages = iter(images)
+    tasks = []
+    seen_pages = set()
+    skipped = {"blank": 0, "duplicate": 0}
+    pages_done = 0
+
+    async def run_batch(encodings):
+        nonlocal pages_done
+        try:
+            image_urls = await asyncio.gather(*encodings)
+            rows = await process_image_batch(client, image_urls, instruction_prompt, rate_limiter)
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            sem.release()
+        pages_done += len(image_urls)
+        if on_batch is not None:
+            on_batch(rows, pages_done)
+        return rows
+
+    async with make_http_client(concurrency) as http_client:
+        client = Mistral(api_key=api_key, async_client=http_client)
+        with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as encode_pool:
+            try:
+                while True:
+                    await sem.acquire()
+                    if failed.is_set():
+                        break
+                    encodings = []
+                    while len(encodings) < batch_size and not failed.is_set():
+                        img, skip_reason = await loop.run_in_executor(None, next_page, pages, seen_pages)
+                        if img is None:
+                            break
+                        if skip_reason is not None:
+                            img.close()
+                            skipped[skip_reason] += 1
+                            pages_done += 1
+                            if on_batch is not None:
+                                on_batch([], pages_done)
+                            continue
+                        encodings.append(loop.run_in_executor(encode_pool, encode_page, img))
+                    if not encodings or failed.is_set():
+                        sem.release()
+                        break
+                    tasks.append(asyncio.create_task(run_batch(encodings)))
+
+                results = await asyncio.gather(*tasks)
+            finally:
+                # On any failure, cancel outstanding batches rather than leave them running.
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+    return [row for rows in results for row in rows], skipped
 
 # --- Main Logic ---
 if uploaded_files:
@@ -141,28 +399,50 @@ if uploaded_files:
     if st.button("Extract Table"):
         with st.spinner("Extracting table data..."):
             try:
-                all_images = []
                 # --- Prepare Images ---
                 if source_option == "From Images":
-                    for f in uploaded_files:
-                        img = Image.open(f)
-                        all_images.append(img)
+                    total_pages = len(uploaded_files)
+                    pages = iter_uploaded_images(uploaded_files)
                 else:  # PDF
                     pdf_bytes = uploaded_files.read()
-                    all_images = pdf_to_images(pdf_bytes, resolution=200)  # Corrected function name and resolution
+                    total_pages = pdf_page_count(pdf_bytes)
+                    pages = iter_pdf_pages(pdf_bytes, resolution=200)
+
+                # --- Show Rows as Batches Finish ---
+                progress_bar = st.progress(0.0)
+                table_placeholder = st.empty()
+                partial_rows = []
+
+                def show_partial(rows, pages_done):
+                    partial_rows.extend(rows)
+                    if partial_rows:
+                        table_placeholder.dataframe(rows_to_dataframe(partial_rows, expected_columns))
+                    progress_bar.progress(min(pages_done / max(total_pages, 1), 1.0))
+
+                # --- Process Pages Concurrently as They Are Produced ---
+                all_data, skipped = asyncio.run(process_images_async(
+                    pages, instruction_prompt, concurrency=int(max_parallel_requests), batch_size=batch_size,
+                    on_batch=show_partial, requests_per_minute=int(requests_per_minute)
+                ))
 
-                # --- Process All Images Concurrently ---
-                all_data = process_images_concurrent(all_images, instruction_prompt, max_workers=8)
+                if skipped["duplicate"]:
+                    st.info(f"Skipped {skipped['duplicate']} page(s) identical to an earlier page.")
+                if skipped["blank"]:
+                    st.info(f"Skipped {skipped['blank']} blank page(s).")
 
                 # --- Combine and Display Data ---
                 if all_data:
-                    df = pd.DataFrame(all_data)
+                    df = rows_to_dataframe(all_data, expected_columns)
                     st.success("Extraction complete! 🎉")
-                    st.dataframe(df)
+                    table_placeholder.dataframe(df)
 
                     # --- Download Excel ---
                     output = BytesIO()
-                    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+                    with pd.ExcelWriter(
+                        output,
+                        engine="xlsxwriter",
+                        engine_kwargs={"options": {"strings_to_urls": False}}
+                    ) as writer:
                         df.to_excel(writer, index=False, sheet_name="Extracted Table")
                     excel_data = output.getvalue()
                     st.download_button(